@@ -0,0 +1,443 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import main
+from encoders import BACKENDS
+from jobqueue import QUEUE_WINDOW, PathTable, SpillStack
+
+# SETTINGS
+MEDIA_DIR = os.path.join(main.LOCAL_DIR, 'benchmarks', 'media')
+RESULTS_PATH = os.path.join(main.LOCAL_DIR, 'benchmarks', 'results.json')
+CALIBRATION_OUTPUT = main.CALIBRATION_PATH # the application's, before any isolation
+
+BENCHMARK_CONFIG = {
+    'video_codec': 'h265',
+    'constant_rate_factor': 28,
+    'speed': 8,
+    'performanceMode': 2,
+    'overwrite': False,
+    'trace': True,
+}
+
+# synthetic media (name, resolution, frame rate, duration in seconds, container)
+# only mp4 files are compressed; other containers measure the cost of scanning past them
+MEDIA_MATRIX = [
+    ('360p-short', '640x360', 30, 5, 'mp4'),
+    ('720p-short', '1280x720', 30, 5, 'mp4'),
+    ('1080p-short', '1920x1080', 30, 5, 'mp4'),
+    ('720p-long', '1280x720', 30, 30, 'mp4'),
+    ('720p-faststart', '1280x720', 30, 5, 'mp4 faststart'),
+    ('720p-mkv', '1280x720', 30, 5, 'mkv'),
+    ('720p-mov', '1280x720', 30, 5, 'mov'),
+]
+
+FILES_PER_DIRECTORY = 1000
+QUEUE_CHECKPOINTS = 10
+
+CALIBRATION_CASE = MEDIA_MATRIX[1] # 720p, 5 seconds
+
+STARTUP_RUNS = 5
+STARTUP_FILES = 100
+STARTUP_PREFIX = 'STARTUP '
+
+STAGES = ['scan', 'probe', 'io-wait', 'encode', 'finalize', 'move', 'tag', 'file']
+SAMPLE_INTERVAL = 0.1
+
+
+def generateMedia(name, resolution, rate, duration, container):
+    """
+    Generate a reproducible synthetic clip using ffmpeg's testsrc and sine sources
+    """
+    extension = container.split()[0]
+    path = os.path.join(MEDIA_DIR, f'{name}.{extension}')
+    if (os.path.exists(path)):
+        return path
+
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc=size={resolution}:rate={rate}:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '192k',
+        '-shortest',
+        '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact',
+        '-map_metadata', '-1',
+        '-metadata', f'title={name}', # ensure the format has tags, as compressFile expects
+    ]
+    if (container == 'mp4 faststart'):
+        cmd += ['-movflags', '+faststart']
+    cmd.append(path)
+
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if (result.returncode != 0):
+        raise Exception(f'ffmpeg failed to generate {name}: {result.stderr.strip()}')
+
+    return path
+
+
+def isolate(workDir, config):
+    """
+    Point the application's config, temp, log, calibration and forecast files at a working directory, away from the user's
+    """
+    main.CONFIG_PATH = os.path.join(workDir, 'config.json')
+    main.CALIBRATION_PATH = os.path.join(workDir, 'calibration.json')
+    main.FORECAST_PATH = os.path.join(workDir, 'forecast.json') # synthetic encodes would skew the user's forecasts
+    main.OUTPUTROOT = os.path.join(workDir, 'temp')
+    main.LOG_DIR = os.path.join(workDir, 'logs')
+    for directory in [main.OUTPUTROOT, main.LOG_DIR]:
+        os.makedirs(directory, exist_ok=True)
+    with open(main.CONFIG_PATH, 'w') as f:
+        json.dump(config, f, indent=4)
+
+
+async def runCase(case, copies, traceMemory=False):
+    """
+    Run one media case through the real scan, probe, encode and finalize path
+    tracemalloc slows allocation, so peak Python memory is only traced when asked, in a run whose timings are not kept
+    """
+    name, resolution, rate, duration, container = case
+    source = generateMedia(*case)
+
+    with tempfile.TemporaryDirectory(prefix=f'{main.APPLICATION_NAME}-') as workDir:
+        isolate(workDir, BENCHMARK_CONFIG)
+
+        inputDir = os.path.join(workDir, 'input')
+        os.mkdir(inputDir)
+        for i in range(copies):
+            shutil.copy(source, os.path.join(inputDir, f'{i:04d}-{os.path.basename(source)}'))
+        bytesIn = sum(os.path.getsize(os.path.join(inputDir, file)) for file in os.listdir(inputDir))
+
+        window = main.MainWindow(asyncio.get_event_loop())
+        window.root.withdraw()
+
+        import psutil
+        supervisor = psutil.Process()
+        peakRss = supervisor.memory_info().rss
+        if (traceMemory):
+            tracemalloc.start()
+        cpuStart = supervisor.cpu_times()
+        start = time.perf_counter()
+
+        window.beginProcess(inputDir)
+        while (window.isAlive):
+            window.root.update()
+            peakRss = max(peakRss, supervisor.memory_info().rss)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+        wallSeconds = time.perf_counter() - start
+        cpuEnd = supervisor.cpu_times()
+        peakTraced = None
+        if (traceMemory):
+            _, peakTraced = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        failed = window.statusLabel['text'].startswith('ERROR')
+        stages = window.tracer.summary()
+        window.root.destroy()
+
+        bytesOut = sum(
+            os.path.getsize(os.path.join(inputDir, file)) for file in os.listdir(inputDir) if file.endswith(' (compressed).mp4')
+        )
+
+    for stage in STAGES:
+        stages.setdefault(stage, {'count': 0, 'total': 0.0, 'mean': 0.0, 'max': 0.0})
+    files = stages['file']['count']
+    cpuSeconds = (cpuEnd.user - cpuStart.user) + (cpuEnd.system - cpuStart.system)
+
+    return {
+        'name': name,
+        'resolution': resolution,
+        'frameRate': rate,
+        'duration': duration,
+        'container': container,
+        'copies': copies,
+        'failed': failed,
+        'files': files,
+        'bytesIn': bytesIn,
+        'bytesOut': bytesOut,
+        'wallSeconds': wallSeconds,
+        'throughput': {
+            'filesPerSecond': files / wallSeconds,
+            'megabytesPerSecond': bytesIn / main.FileSizeUnit.MB.value / wallSeconds,
+            'framesPerSecond': files * rate * duration / wallSeconds,
+        },
+        'stages': stages,
+        'supervisorCpu': {
+            'seconds': cpuSeconds,
+            'percent': cpuSeconds / wallSeconds * 100,
+        },
+        'peakMemory': {
+            'rssBytes': peakRss,
+            'pythonBytes': peakTraced,
+        },
+    }
+
+
+async def runStartupChild(workDir, spawnTime):
+    """
+    Launch the application with autorun, and print how long after spawning each startup milestone was reached
+    Run in a fresh interpreter by runStartupBenchmark
+    """
+    milestones = {'imported': time.time() - spawnTime}
+
+    isolate(workDir, {**BENCHMARK_CONFIG, 'autorun': True, 'autorunPath': os.path.join(workDir, 'input')})
+    window = main.MainWindow(asyncio.get_event_loop())
+    window.root.update()
+    milestones['window'] = time.time() - spawnTime
+
+    while (not window.tracer.events):
+        window.root.update()
+        await asyncio.sleep(0)
+    milestones['scan'] = time.time() - spawnTime
+
+    print(STARTUP_PREFIX + json.dumps(milestones), flush=True)
+    os._exit(0) # don't wait for capability detection or compression
+
+
+def runStartupBenchmark(runs):
+    """
+    Measure the time from launch to the window appearing and the autorun scan starting
+    Cold launches have no bytecode cache for the application's modules; warm launches do
+    """
+    results = {}
+    for mode in ['cold', 'warm']:
+        samples = {}
+        for i in range(runs + (mode == 'warm')): # the first warm launch populates the cache
+            env = dict(os.environ)
+            if (mode == 'cold'):
+                shutil.rmtree(os.path.join(main.LOCAL_DIR, '__pycache__'), ignore_errors=True)
+                env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+            with tempfile.TemporaryDirectory(prefix=f'{main.APPLICATION_NAME}-') as workDir:
+                inputDir = os.path.join(workDir, 'input')
+                os.mkdir(inputDir)
+                for j in range(STARTUP_FILES):
+                    open(os.path.join(inputDir, f'{j:04d}.mp4'), 'w').close()
+
+                spawnTime = time.time()
+                result = subprocess.run([sys.executable, os.path.abspath(__file__), '--startup-child', workDir, str(spawnTime)], capture_output=True, text=True, env=env)
+
+            lines = [line for line in result.stdout.splitlines() if line.startswith(STARTUP_PREFIX)]
+            if (not lines):
+                raise Exception(f'startup run failed: {result.stderr.strip()}')
+            if ((mode == 'warm') and (i == 0)):
+                continue
+
+            for milestone, seconds in json.loads(lines[0][len(STARTUP_PREFIX):]).items():
+                samples.setdefault(milestone, []).append(seconds)
+
+        results[mode] = {
+            milestone: {'mean': sum(values) / len(values), 'min': min(values), 'max': max(values)} for milestone, values in samples.items()
+        }
+
+    return results
+
+
+def runCalibration(crf):
+    """
+    Measure the real speed and output size of each available encoder backend and preset on this host
+    Speeds are stored per pixel and sizes per pixel, so they can be applied to sources of any resolution
+    """
+    name, resolution, rate, duration, container = CALIBRATION_CASE
+    source = generateMedia(*CALIBRATION_CASE)
+    width, height = (int(value) for value in resolution.split('x'))
+    frames = rate * duration
+
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True)
+    available = set(line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1)
+
+    encoders = {}
+    with tempfile.TemporaryDirectory(prefix=f'{main.APPLICATION_NAME}-') as workDir:
+        for backend in BACKENDS:
+            if (backend.name not in available):
+                print(f'{backend.name}: not available', file=sys.stderr)
+                continue
+
+            for preset in dict.fromkeys(backend.presets):
+                outputFile = os.path.join(workDir, f'{backend.name}-{preset}.mp4')
+                cmd = ['ffmpeg', '-y', '-v', 'error', '-i', source, *backend.args(crf, preset, os.cpu_count()), '-an', outputFile]
+
+                start = time.perf_counter()
+                result = subprocess.run(cmd, capture_output=True, text=True)
+                seconds = time.perf_counter() - start
+                if (result.returncode != 0):
+                    print(f'{backend.name} {preset}: failed ({result.stderr.strip()})', file=sys.stderr)
+                    continue
+
+                size = os.path.getsize(outputFile)
+                encoders.setdefault(backend.name, {})[preset] = {
+                    'fps': frames / seconds,
+                    'pixelsPerSecond': frames * width * height / seconds,
+                    'bitsPerPixel': size * 8 / (frames * width * height),
+                    'sizeRatio': size / os.path.getsize(source),
+                }
+                print(f'{backend.name} {preset}: {frames / seconds:.1f} fps', file=sys.stderr)
+
+    return {
+        'commit': getCommit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'source': name,
+        'crf': crf,
+        'encoders': encoders,
+    }
+
+
+def runQueueBenchmark(count, window, baseline=False):
+    """
+    Measure the memory used to queue a synthetic tree of `count` files
+    Memory is sampled at checkpoints while filling, and should stay flat once the window is full
+    """
+    with tempfile.TemporaryDirectory(prefix=f'{main.APPLICATION_NAME}-') as spillDir:
+        queue = [] if (baseline) else SpillStack(PathTable(), spillDir, window)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        samples = []
+        for i in range(count):
+            directory = f'{i // FILES_PER_DIRECTORY // 100:04d}'
+            queue.append(os.path.join('D:\\', 'library', directory, f'{i // FILES_PER_DIRECTORY % 100:02d}', f'clip_{i:08d}.mp4'))
+            if ((i + 1) % max(1, count // QUEUE_CHECKPOINTS) == 0):
+                samples.append({'files': i + 1, 'bytes': tracemalloc.get_traced_memory()[0]})
+        fillSeconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        while (len(queue) > 0):
+            queue.pop()
+        drainSeconds = time.perf_counter() - start
+
+        _, peakTraced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'files': count,
+        'queue': 'list' if (baseline) else 'SpillStack',
+        'window': None if (baseline) else window,
+        'fillSeconds': fillSeconds,
+        'drainSeconds': drainSeconds,
+        'peakBytes': peakTraced,
+        'samples': samples,
+    }
+
+
+def getCommit():
+    """
+    Get the current git commit, if available
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=main.LOCAL_DIR)
+        return result.stdout.strip() if (result.returncode == 0) else None
+    except FileNotFoundError:
+        return None
+
+
+async def runBenchmark(cases, copies, pythonMemory=False):
+    """
+    Run every case and collect the results, tracing peak Python memory in a separate pass if asked
+    """
+    results = []
+    for case in cases:
+        print(f'{case[0]}...', file=sys.stderr)
+        result = await runCase(case, copies)
+        if (pythonMemory):
+            result['peakMemory']['pythonBytes'] = (await runCase(case, copies, traceMemory=True))['peakMemory']['pythonBytes']
+        results.append(result)
+
+    return {
+        'commit': getCommit(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpuCount': os.cpu_count(),
+        'config': BENCHMARK_CONFIG,
+        'cases': results,
+    }
+
+
+def compareResults(basePath, headPath):
+    """
+    Print the relative change of each metric between two result files
+    """
+    with open(basePath) as f:
+        base = json.load(f)
+    with open(headPath) as f:
+        head = json.load(f)
+
+    metrics = [
+        ('wall (s)', lambda case: case['wallSeconds']),
+        ('files/s', lambda case: case['throughput']['filesPerSecond']),
+        ('fps', lambda case: case['throughput']['framesPerSecond']),
+        ('probe (s)', lambda case: case['stages']['probe']['mean']),
+        ('encode (s)', lambda case: case['stages']['encode']['mean']),
+        ('finalize (s)', lambda case: case['stages']['finalize']['mean']),
+        ('cpu (%)', lambda case: case['supervisorCpu']['percent']),
+        ('rss (MB)', lambda case: case['peakMemory']['rssBytes'] / main.FileSizeUnit.MB.value),
+    ]
+
+    print(f'{base["commit"]} --> {head["commit"]}')
+    baseCases = {case['name']: case for case in base['cases']}
+    for case in head['cases']:
+        if (case['name'] not in baseCases):
+            continue
+        print(case['name'])
+        for label, metric in metrics:
+            before = metric(baseCases[case['name']])
+            after = metric(case)
+            change = ((after - before) / before * 100) if (before) else 0.0
+            print(f'\t{label:<14}{before:>12.3f}{after:>12.3f}{change:>+10.1f}%')
+
+
+if (__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description=f'Benchmark the {main.APPLICATION_NAME} encode pipeline')
+    parser.add_argument('--output', default=RESULTS_PATH, help='where to write the JSON results')
+    parser.add_argument('--copies', type=int, default=3, help='number of copies of each clip to compress')
+    parser.add_argument('--case', action='append', help='only run the named case (repeatable)')
+    parser.add_argument('--python-memory', action='store_true', help='also trace peak Python memory, in a second (untimed) run of each case')
+    parser.add_argument('--queue', type=int, metavar='FILES', help='measure queue memory for a synthetic tree of FILES files instead of running')
+    parser.add_argument('--queue-window', type=int, default=QUEUE_WINDOW, help='entries held in memory per queue')
+    parser.add_argument('--baseline', action='store_true', help='measure a plain list instead of the queue')
+    parser.add_argument('--startup', action='store_true', help='measure cold and warm launch times instead of running')
+    parser.add_argument('--startup-child', nargs=2, metavar=('DIR', 'SPAWN'), help=argparse.SUPPRESS)
+    parser.add_argument('--calibrate', action='store_true', help=f'measure each encoder backend and preset, and store the results for the application ({os.path.basename(main.CALIBRATION_PATH)})')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if (args.startup_child):
+        asyncio.run(runStartupChild(args.startup_child[0], float(args.startup_child[1])))
+    elif (args.compare):
+        compareResults(*args.compare)
+    elif (args.calibrate):
+        results = runCalibration(BENCHMARK_CONFIG['constant_rate_factor'])
+        with open(CALIBRATION_OUTPUT, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(CALIBRATION_OUTPUT)
+    else:
+        if (args.startup):
+            results = {'commit': getCommit(), 'timestamp': datetime.datetime.now().isoformat(), 'startup': runStartupBenchmark(STARTUP_RUNS)}
+            for mode, milestones in results['startup'].items():
+                print(mode + ''.join(f'\t{milestone}: {timing["mean"]:.3f}s' for milestone, timing in milestones.items()), file=sys.stderr)
+        elif (args.queue):
+            results = {'commit': getCommit(), 'timestamp': datetime.datetime.now().isoformat(), 'queue': runQueueBenchmark(args.queue, args.queue_window, args.baseline)}
+            for sample in results['queue']['samples']:
+                print(f'{sample["files"]:>12}{sample["bytes"] / main.FileSizeUnit.MB.value:>12.2f} MB', file=sys.stderr)
+        else:
+            cases = [case for case in MEDIA_MATRIX if (not args.case) or (case[0] in args.case)]
+            results = asyncio.run(runBenchmark(cases, args.copies, args.python_memory))
+
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(args.output)
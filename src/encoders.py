@@ -0,0 +1,167 @@
+import json
+import os
+
+MAX_CRF = 51 # range of the CRF setting (x264/x265 scale)
+SPEEDS = 9 # positions of the efficiency setting, slowest first
+
+
+class EncoderBackend:
+    """
+    An ffmpeg video encoder, with its own presets, thread model and rate control
+    """
+    name = None # ffmpeg encoder
+    codec = None # video_codec setting
+    presets = [] # slowest first
+    tunes = frozenset() # accepted -tune values
+    hardware = False
+
+    def preset(self, speed):
+        """
+        Map the efficiency setting (0 slowest to SPEEDS - 1 fastest) onto one of the encoder's presets
+        """
+        return self.presets[round(speed / (SPEEDS - 1) * (len(self.presets) - 1))]
+
+
+    def effort(self, preset):
+        """
+        Get how fast a preset is, from 0 (slowest) to 1 (fastest), or None if unknown
+        """
+        if (preset not in self.presets):
+            return None
+        return self.presets.index(preset) / max(1, len(self.presets) - 1)
+
+
+    def quality(self, crf):
+        """
+        Map the CRF setting onto the encoder's quality scale
+        """
+        return crf
+
+
+    def args(self, crf, preset, threads, tune=None):
+        """
+        Get the ffmpeg arguments for the video stream
+        """
+        raise NotImplementedError
+
+
+class X264(EncoderBackend):
+    name = 'libx264' # libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+    codec = 'h264'
+    presets = ['veryslow', 'slower', 'slow', 'medium', 'fast', 'faster', 'veryfast', 'superfast', 'ultrafast']
+    tunes = frozenset(['film', 'animation', 'grain', 'stillimage', 'fastdecode', 'zerolatency', 'psnr', 'ssim'])
+
+    def args(self, crf, preset, threads, tune=None):
+        args = ['-c:v', self.name, '-crf', str(self.quality(crf)), '-preset', preset, '-threads', str(threads)]
+        if (tune):
+            args += ['-tune', tune]
+        return args
+
+
+class X265(X264):
+    name = 'libx265' # libx265 H.265 / HEVC (codec hevc)
+    codec = 'h265'
+    tunes = frozenset(['animation', 'grain', 'fastdecode', 'zerolatency', 'psnr', 'ssim'])
+
+    def args(self, crf, preset, threads, tune=None):
+        # x265 sizes its own thread pool, rather than using -threads
+        args = ['-c:v', self.name, '-crf', str(self.quality(crf)), '-preset', preset, '-x265-params', f'log-level=quiet:pools={threads}']
+        if (tune):
+            args += ['-tune', tune]
+        return args
+
+
+class NvencH264(EncoderBackend):
+    name = 'h264_nvenc' # NVIDIA NVENC H.264 encoder (codec h264)
+    codec = 'h264'
+    presets = ['slow', 'medium', 'fast']
+    tunes = frozenset(['hq', 'll', 'ull', 'lossless'])
+    hardware = True
+
+    def args(self, crf, preset, threads, tune=None):
+        # encoding runs on the GPU, so there is no thread setting
+        args = [
+            '-c:v', self.name,
+            '-rc', 'vbr_hq',            # Variable Bit Rate with High Quality mode
+            '-cq', str(self.quality(crf)),
+            '-b:v', '0',                # Set bitrate to 0 for VBR mode
+            '-preset', preset,
+        ]
+        if (tune):
+            args += ['-tune', tune]
+        return args
+
+
+class NvencHevc(NvencH264):
+    name = 'hevc_nvenc' # NVIDIA NVENC hevc encoder (codec hevc)
+    codec = 'h265'
+
+
+class SvtAv1(EncoderBackend):
+    name = 'libsvtav1' # SVT-AV1 (codec av1)
+    codec = 'av1'
+    presets = ['2', '3', '4', '5', '6', '7', '8', '10', '12'] # of 0 (slowest) to 13
+
+    def quality(self, crf):
+        return max(1, round(crf / MAX_CRF * 63)) # 1-63
+
+    def args(self, crf, preset, threads, tune=None):
+        # lp limits the logical processors used
+        return ['-c:v', self.name, '-crf', str(self.quality(crf)), '-preset', preset, '-svtav1-params', f'lp={threads}']
+
+
+class Vp9(EncoderBackend):
+    name = 'libvpx-vp9' # libvpx VP9 (codec vp9)
+    codec = 'vp9'
+    presets = ['0', '1', '2', '3', '4', '5', '6', '7', '8'] # -cpu-used
+
+    def quality(self, crf):
+        return round(crf / MAX_CRF * 63) # 0-63
+
+    def args(self, crf, preset, threads, tune=None):
+        # constant quality mode needs a zero bitrate; row-mt lets the threads work within tiles
+        return [
+            '-c:v', self.name,
+            '-crf', str(self.quality(crf)), '-b:v', '0',
+            '-deadline', 'good', '-cpu-used', preset,
+            '-row-mt', '1', '-threads', str(threads),
+        ]
+
+
+BACKENDS = [X264(), X265(), NvencH264(), NvencHevc(), SvtAv1(), Vp9()]
+
+
+def getBackend(name):
+    """
+    Get a backend by its ffmpeg encoder name
+    """
+    return next((backend for backend in BACKENDS if backend.name == name), None)
+
+
+def selectBackend(codec, nvenc=False):
+    """
+    Get the backend for a video_codec setting, preferring hardware encoders when available
+    """
+    candidates = [backend for backend in BACKENDS if backend.codec == codec]
+    if (not candidates):
+        raise ValueError(f'unknown video codec {codec} (expected one of {", ".join(sorted(set(backend.codec for backend in BACKENDS)))})')
+
+    if (nvenc):
+        hardware = [backend for backend in candidates if backend.hardware]
+        if (hardware):
+            return hardware[0]
+    return next(backend for backend in candidates if not backend.hardware)
+
+
+def loadCalibration(path):
+    """
+    Load measured encoder speeds and sizes, as written by `benchmark.py --calibrate`
+    { encoder: { preset: {"fps": ..., "pixelsPerSecond": ..., "bitsPerPixel": ..., "sizeRatio": ...} } }
+    """
+    if (not os.path.exists(path)):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f).get('encoders', {})
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,128 @@
+import json
+import os
+
+from rules import getFileInfo
+
+EWMA_WEIGHT = 0.2 # weight of the newest job in the running averages
+RESOLUTION_BUCKETS = [480, 720, 1080, 1440, 2160, 4320]
+
+
+def getResolutionBucket(height):
+    """
+    Group a source height into a standard resolution
+    """
+    if (not height):
+        return '*'
+    return f'{next((bucket for bucket in RESOLUTION_BUCKETS if height <= bucket), RESOLUTION_BUCKETS[-1])}p'
+
+
+def getSourcePixels(metadata):
+    """
+    Get the number of pixels in a source's video stream (width x height x frames)
+    """
+    info = getFileInfo(metadata)
+    frames = info['frames'] or ((info['duration'] or 0) * (info['frameRate'] or 0))
+    return (info['width'] or 0) * (info['height'] or 0) * frames, info['height']
+
+
+class Forecaster:
+    """
+    Learns encode speed per encoder, preset and resolution, and the compression ratio, from finished jobs
+    Speeds are kept in pixels per second, so that they can be applied to the backlog's source bytes,
+    split across resolutions by the mix of recent jobs
+    """
+
+    def __init__(self, path, calibration=None):
+        self.path = path
+        self.calibration = calibration or {} # from benchmark.py --calibrate, used until jobs have been measured
+
+        self.model = {}
+        try:
+            with open(self.path) as f:
+                self.model = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+
+    def update(self, key, values):
+        """
+        Fold a job's measurements into the running averages under a key
+        """
+        entry = self.model.get(key)
+        if (entry is None):
+            self.model[key] = {**values, 'samples': 1}
+            return
+
+        for name, value in values.items():
+            entry[name] = entry[name] + EWMA_WEIGHT * (value - entry[name])
+        entry['samples'] += 1
+
+
+    def record(self, encoder, preset, metadata, seconds, sourceBytes, outputBytes):
+        """
+        Learn from a finished encode
+        """
+        pixels, height = getSourcePixels(metadata)
+        if ((not pixels) or (not sourceBytes) or (seconds <= 0)):
+            return
+
+        values = {'pixelsPerSecond': pixels / seconds, 'sizeRatio': min(outputBytes, sourceBytes) / sourceBytes} # larger results are discarded
+        resolution = getResolutionBucket(height)
+        for bucket in [resolution, '*']:
+            self.update(f'{encoder}|{preset}|{bucket}', values)
+            self.update(f'source|{bucket}', {'pixelsPerByte': pixels / sourceBytes})
+
+        # share of recent source bytes at each resolution
+        mix = self.model.setdefault('mix', {})
+        for bucket in mix:
+            mix[bucket] *= 1 - EWMA_WEIGHT
+        mix[resolution] = mix.get(resolution, 0) + EWMA_WEIGHT * sourceBytes
+
+
+    def save(self):
+        """
+        Store the model for future runs
+        """
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.model, f, indent=4, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            print(f"\tError saving forecast: '{e}'")
+
+
+    def getRates(self, encoder, preset, resolution='*'):
+        """
+        Get the expected pixels per second and size ratio of a resolution bucket, falling back to any resolution, then to calibration
+        """
+        for bucket in [resolution, '*']:
+            entry = self.model.get(f'{encoder}|{preset}|{bucket}')
+            if (entry):
+                return entry['pixelsPerSecond'], entry['sizeRatio']
+
+        calibration = self.calibration.get(encoder, {}).get(preset)
+        if (calibration):
+            return calibration['pixelsPerSecond'], None # calibration sizes depend on its lossless source
+        return None, None
+
+
+    def forecast(self, encoder, preset, backlogBytes):
+        """
+        Estimate the seconds needed to encode, and the bytes saved by, a backlog of source bytes
+        Either is None until there is enough history
+        """
+        mix = self.model.get('mix') or {'*': 1}
+        total = sum(mix.values())
+
+        seconds, bytesSaved = 0, 0
+        for resolution, share in mix.items():
+            bucketBytes = backlogBytes * share / total
+            pixelsPerSecond, sizeRatio = self.getRates(encoder, preset, resolution)
+            pixelsPerByte = (self.model.get(f'source|{resolution}') or self.model.get('source|*') or {}).get('pixelsPerByte')
+
+            if (seconds is not None):
+                seconds = (seconds + bucketBytes * pixelsPerByte / pixelsPerSecond) if (pixelsPerSecond and pixelsPerByte) else None
+            if (bytesSaved is not None):
+                bytesSaved = (bytesSaved + bucketBytes * max(0, 1 - sizeRatio)) if (sizeRatio is not None) else None
+
+        return seconds, bytesSaved
@@ -0,0 +1,211 @@
+import contextlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+CHUNK_SIZE = 4 * 10 ** 6 # bytes per read/write when copying
+
+
+def getMount(path):
+    """
+    Get the drive, share or mount point which a path lives on
+    """
+    path = os.path.abspath(path)
+
+    drive, _ = os.path.splitdrive(path)
+    if (drive):
+        return drive.lower() # drive letter or UNC share
+
+    while (not os.path.ismount(path)):
+        parent = os.path.dirname(path)
+        if (parent == path):
+            break
+        path = parent
+    return path
+
+
+class MountLimiter:
+    """
+    Limits the number of concurrent copies touching each mount
+    """
+
+    def __init__(self, concurrency=1):
+        self.concurrency = max(1, concurrency)
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+
+    def semaphore(self, mount):
+        with self.lock:
+            if (mount not in self.semaphores):
+                self.semaphores[mount] = threading.Semaphore(self.concurrency)
+            return self.semaphores[mount]
+
+
+    @contextlib.contextmanager
+    def acquire(self, *paths):
+        """
+        Hold a slot on the mount of every given path (in a fixed order, to avoid deadlock)
+        """
+        mounts = sorted(set(getMount(path) for path in paths))
+        with contextlib.ExitStack() as stack:
+            for mount in mounts:
+                stack.enter_context(self.semaphore(mount))
+            yield
+
+
+def copyFile(source, destination, limiter, bandwidth=0):
+    """
+    Copy a file in chunks, holding the mounts' slots and capping throughput at `bandwidth` bytes per second (0 for unlimited)
+    The copy is written beside the destination and swapped in once complete, so an existing destination is never left partial
+    """
+    directory, name = os.path.split(os.path.abspath(destination))
+    partial = os.path.join(directory, f'.{name}.partial')
+
+    with limiter.acquire(source, directory):
+        start = time.perf_counter()
+        copied = 0
+
+        try:
+            with open(source, 'rb') as src, open(partial, 'wb') as dst:
+                while (chunk := src.read(CHUNK_SIZE)):
+                    dst.write(chunk)
+                    copied += len(chunk)
+
+                    if (bandwidth):
+                        # sleep until the average rate falls back under the cap
+                        ahead = copied / bandwidth - (time.perf_counter() - start)
+                        if (ahead > 0):
+                            time.sleep(ahead)
+
+            shutil.copystat(source, partial)
+            os.replace(partial, destination)
+        except BaseException:
+            if (os.path.exists(partial)):
+                os.remove(partial)
+            raise
+
+
+def moveFile(source, destination, limiter, bandwidth=0):
+    """
+    Move a file; a rename if both paths share a device, otherwise a throttled copy
+    """
+    if (os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(destination))).st_dev):
+        os.replace(source, destination)
+    else:
+        copyFile(source, destination, limiter, bandwidth)
+        os.remove(source)
+
+
+class PrefetchCache:
+    """
+    Local scratch copies of queued source files, evicted least-recently-used beyond `maxSize` bytes
+    """
+
+    def __init__(self, scratchDir, maxSize, limiter, bandwidth=0):
+        self.scratchDir = scratchDir
+        self.maxSize = maxSize
+        self.limiter = limiter
+        self.bandwidth = bandwidth
+
+        self.entries = OrderedDict() # source --> (local copy, size)
+        self.pinned = set() # sources currently being read
+        self.size = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.scratchDir, exist_ok=True)
+
+
+    def fetch(self, source):
+        """
+        Copy a source file into the cache (blocking), returning the local copy or None if it does not fit
+        """
+        size = os.path.getsize(source)
+        if (size > self.maxSize):
+            return None
+
+        with self.lock:
+            if (source in self.entries):
+                self.entries.move_to_end(source)
+                return self.entries[source][0]
+
+            self.evict(self.maxSize - size)
+            if (self.size + size > self.maxSize):
+                return None # remaining entries are pinned
+            self.size += size # reserve space while copying
+
+        localPath = os.path.join(self.scratchDir, f'{abs(hash(source)):x}_{os.path.basename(source)}')
+        try:
+            copyFile(source, localPath, self.limiter, self.bandwidth)
+        except Exception:
+            with self.lock:
+                self.size -= size
+            if (os.path.exists(localPath)):
+                os.remove(localPath)
+            raise
+
+        with self.lock:
+            self.entries[source] = (localPath, size)
+        return localPath
+
+
+    def get(self, source):
+        """
+        Get the local copy of a source file, if it is cached and unchanged
+        The copy is pinned (never evicted) until released
+        """
+        with self.lock:
+            entry = self.entries.get(source)
+            if (entry is None):
+                return None
+            if (os.path.getsize(source) != entry[1]):
+                self.remove(source)
+                return None
+
+            self.entries.move_to_end(source)
+            self.pinned.add(source)
+            return entry[0]
+
+
+    def release(self, source):
+        """
+        Remove a copy returned by get once it has been read, freeing its space for the next prefetch
+        """
+        with self.lock:
+            self.pinned.discard(source)
+            if (source in self.entries):
+                self.remove(source)
+
+
+    def evict(self, targetSize):
+        """
+        Remove least-recently-used entries until the cache holds at most `targetSize` bytes (lock must be held)
+        """
+        for source in list(self.entries):
+            if (self.size <= targetSize):
+                break
+            if (source not in self.pinned):
+                self.remove(source)
+
+
+    def remove(self, source):
+        """
+        Remove an entry (lock must be held)
+        """
+        localPath, size = self.entries.pop(source)
+        self.size -= size
+        try:
+            os.remove(localPath)
+        except FileNotFoundError:
+            pass
+
+
+    def clear(self):
+        """
+        Remove every cached copy
+        """
+        with self.lock:
+            self.pinned.clear()
+            self.evict(0)
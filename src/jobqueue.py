@@ -0,0 +1,136 @@
+import os
+import pickle
+import tempfile
+from array import array
+
+QUEUE_WINDOW = 100000 # entries held in memory per stack
+
+
+class PathTable:
+    """
+    Interned directory paths, so that queued entries only store a small integer per directory
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.ids = {}
+
+
+    def intern(self, path):
+        """
+        Get the id of a directory, adding it if unseen
+        """
+        id = self.ids.get(path)
+        if (id is None):
+            id = len(self.paths)
+            self.paths.append(path)
+            self.ids[path] = id
+        return id
+
+
+    def __getitem__(self, id):
+        return self.paths[id]
+
+
+class SpillStack:
+    """
+    LIFO stack of paths, stored as (directory id, name) pairs
+    At most `window` entries are held in memory; older entries are spilled to disk in segments
+    """
+
+    def __init__(self, table, spillDir, window=QUEUE_WINDOW):
+        self.table = table
+        self.spillDir = spillDir
+        self.window = max(2, window)
+
+        self.directories = array('L')
+        self.names = []
+        self.segments = [] # (path, number of entries), oldest first
+        self.spilled = 0
+
+
+    def __len__(self):
+        return len(self.names) + self.spilled
+
+
+    def append(self, path):
+        """
+        Push a path onto the stack
+        """
+        directory, name = os.path.split(path)
+        self.directories.append(self.table.intern(directory))
+        self.names.append(name)
+
+        if (len(self.names) > self.window):
+            self.spill()
+
+
+    def pop(self):
+        """
+        Pop the most recently pushed path
+        """
+        if (not self.names):
+            if (not self.segments):
+                raise IndexError('pop from empty stack')
+            self.load()
+
+        return os.path.join(self.table[self.directories.pop()], self.names.pop())
+
+
+    def peek(self):
+        """
+        Get the most recently pushed path without removing it
+        """
+        if (not self.names):
+            if (not self.segments):
+                raise IndexError('peek from empty stack')
+            self.load()
+
+        return os.path.join(self.table[self.directories[-1]], self.names[-1])
+
+
+    def spill(self):
+        """
+        Move the oldest half of the in-memory entries to a segment on disk
+        """
+        count = len(self.names) // 2
+
+        fd, path = tempfile.mkstemp(dir=self.spillDir, suffix='.queue')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((self.directories[:count].tobytes(), self.names[:count]), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        del self.directories[:count]
+        del self.names[:count]
+        self.segments.append((path, count))
+        self.spilled += count
+
+
+    def load(self):
+        """
+        Read the most recently spilled segment back into memory
+        """
+        path, count = self.segments.pop()
+        with open(path, 'rb') as f:
+            directories, names = pickle.load(f)
+        os.remove(path)
+
+        self.directories = array('L')
+        self.directories.frombytes(directories)
+        self.names = names
+        self.spilled -= count
+
+
+    def clear(self):
+        """
+        Empty the stack, removing any spilled segments
+        """
+        for path, _ in self.segments:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        self.directories = array('L')
+        self.names = []
+        self.segments = []
+        self.spilled = 0
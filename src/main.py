@@ -4,18 +4,21 @@ import json
 import math
 import os
 import re
-import shutil
 import subprocess
 import sys
 import time
 import tkinter as tk
-import winreg as wr
 from enum import Enum
-from idlelib.tooltip import Hovertip
-from tkinter import filedialog, messagebox, ttk
+from tkinter import ttk
 
-import psutil
-from mutagen.mp4 import MP4
+from encoders import SPEEDS, X264, getBackend, loadCalibration, selectBackend
+from forecast import Forecaster
+from iothrottle import MountLimiter, PrefetchCache, moveFile
+from jobqueue import QUEUE_WINDOW, PathTable, SpillStack
+from profiling import Tracer
+from rules import RuleEngine, checkProfile
+from scaling import DEFAULT_SCALER, checkScaler, planScaling
+from tagging import TagStore
 
 # SETTINGS
 APPLICATION_NAME = 'tortle-stomp'
@@ -27,6 +30,8 @@ COMPRESSION_TAG = 'ffmpeg'
 OUTPUTROOT = os.path.join(LOCAL_DIR, 'temp')
 LOG_DIR = os.path.join(LOCAL_DIR, 'logs')
 CONFIG_PATH = os.path.join(LOCAL_DIR, 'config.json')
+CALIBRATION_PATH = os.path.join(LOCAL_DIR, 'calibration.json')
+FORECAST_PATH = os.path.join(LOCAL_DIR, 'forecast.json')
 
 # MISC
 COMMENT_TEMPLATE = '{} (-c:v {} -crf {} -preset {} -c:a {} -b:a {})'
@@ -41,11 +46,6 @@ TURTLE_FACE = '({0}\_/{0})  {1}'
 POSES_ASCII = ['|_|_|  |_|_|', '|_|-/  |_|-/', '/-/_|  /-/_|']
 SLEEP_EFFECT = '  ₂ z Z'
 
-FFMPEG_SPEEDS = {
-    'default': ['veryslow', 'slower', 'slow', 'medium', 'fast', 'faster', 'veryfast', 'superfast', 'ultrafast'],
-    'nvenc': ['slow', 'medium', 'fast']
-}
-
 class FileSizeUnit(Enum):
     KB = 10 ** 3
     MB = 10 ** 6
@@ -73,12 +73,17 @@ class App:
         if (not os.path.exists(LOG_DIR)):
             os.mkdir(LOG_DIR)
 
+        self.window = None
         try:
             self.window = MainWindow(asyncio.get_event_loop())
             await self.window.show()
         except asyncio.CancelledError:
             pass
         finally:
+            # write tags still pending when the window is closed, so their files aren't compressed again
+            if (self.window and self.window.tags):
+                self.window.tags.flush()
+
             # Clean up tasks, including subprocesses
             asyncio.gather(*asyncio.all_tasks(), return_exceptions=True).cancel()
 
@@ -92,8 +97,22 @@ class MainWindow(tk.Tk):
     isAlive = False
     isRunning = False
 
-    directoryStack = []
-    fileStack = []
+    nvenc = False
+    cuda = False
+
+    directoryStack = None
+    fileStack = None
+
+    ioLimiter = MountLimiter()
+    prefetcher = None
+    prefetchTask = None
+
+    tags = None
+    tagFlush = None
+
+    forecaster = None
+    currentEncoder = None
+    backlogBytes = 0
 
 
     # tkinter
@@ -106,7 +125,7 @@ class MainWindow(tk.Tk):
         self.root = tk.Tk()
 
         # WINDOW
-        self.root.geometry("545x190")
+        self.root.geometry("545x210")
         self.root.resizable(width=False, height=False)
 
         self.root.columnconfigure(0, minsize=76, weight=1)
@@ -159,12 +178,24 @@ class MainWindow(tk.Tk):
 
         self.timerLabel = tk.Label(text='0:00:00  |  0.0%  |  0:00:00')
         self.timerLabel.grid(row=4, column=2, sticky='EW', padx=0, pady=0)
+
+        self.forecastLabel = tk.Label(text='')
+        self.forecastLabel.grid(row=5, columnspan=5, padx=(8, 8), pady=(0, 4))
         self.currentFileTime = 0
         self.currentProcessTime = 0
         self.timeOfLastCheck = 0
+        self.encodeTime = 0
+        self.ioWaitTime = 0
+        self.pausedTime = 0 # total, so that pauses can be excluded from encode times
+        self.pauseStart = 0
 
         # VARIABLES
         self.animation = 0
+        self.tracer = Tracer()
+
+        # detect ffmpeg's capabilities in the background, so that scanning can start immediately
+        self.capabilities = self.loop.create_task(self.detectCapabilities())
+        self.capabilities.add_done_callback(self.applyCapabilities)
 
         # AUTORUN
         self.loop.create_task(self.handleAutorun())
@@ -191,48 +222,134 @@ class MainWindow(tk.Tk):
         with open(CONFIG_PATH) as f:
             config = json.load(f)
 
-        vcodec = config.get('video_codec', 'h265')
+        self.videoCodec = config.get('video_codec', 'h265')
 
         self.acodec = config.get('audio_codec', 'libmp3lame')
         self.crf = config.get('constant_rate_factor', 0)
         self.speed = config.get('speed', 0)
         self.abitrate = config.get('bitrate', '320k')
+        self.tune = config.get('tune', None)
+        self.maxResolution = config.get('max_resolution', None) # e.g. 1080, applied to the shorter side
+        self.maxFrameRate = config.get('max_frame_rate', None)
+        self.scaler = config.get('scaler', DEFAULT_SCALER)
+        self.inFileTags = config.get('inFileTags', False)
+        self.ruleConfig = config.get('rules', [])
 
         self.performanceMode = config.get('performanceMode', 0)
 
         self.autorun = config.get('autorunPath', None) if (config.get('autorun', False)) else False
         self.overwrite = config.get('overwrite', False)
+        self.queueWindow = config.get('queueWindow', QUEUE_WINDOW)
 
-        # hardware acceleration
-        result = subprocess.run(['ffmpeg', '-encoders'], capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        nvenc = 'nvenc' in result.stdout
-        if (nvenc):
-            if (vcodec == 'h265'):
-                self.vcodec = 'hevc_nvenc' # NVIDIA NVENC hevc encoder (codec hevc)
-            else:
-                self.vcodec = 'h264_nvenc' # NVIDIA NVENC H.264 encoder (codec h264)
-        else:
-            if (vcodec == 'h265'):
-                self.vcodec = 'libx265' # libx265 H.265 / HEVC (codec hevc)
-            else:
-                self.vcodec = 'libx264' # libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+        # io
+        self.ioConcurrency = config.get('ioConcurrency', 1) # per drive/share
+        self.ioBandwidth = config.get('ioBandwidth', 0) * FileSizeUnit.MB.value # 0 is unlimited
+        self.prefetch = config.get('prefetch', False)
+        self.prefetchCacheSize = config.get('prefetchCacheSize', 10) * FileSizeUnit.GB.value
+        self.scratchPath = config.get('scratchPath', os.path.join(OUTPUTROOT, 'cache'))
+
+        # profiling
+        self.trace = config.get('trace', False)
+        self.cprofile = config.get('cprofile', False)
+
+
+    async def detectCapabilities(self):
+        """
+        Check ffmpeg and ffprobe are installed, and which hardware acceleration they support
+        """
+        async def run(*cmd):
+            try:
+                process = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, creationflags=subprocess.CREATE_NO_WINDOW)
+                stdout, _ = await process.communicate()
+            except FileNotFoundError:
+                return None
+            return stdout.decode(errors='replace') if (process.returncode == 0) else None
+
+        encoders, hwaccels, ffprobe = await asyncio.gather(
+            run('ffmpeg', '-hide_banner', '-encoders'),
+            run('ffmpeg', '-hide_banner', '-hwaccels'),
+            run('ffprobe', '-version'),
+        )
+
+        return {
+            'ffmpeg': encoders is not None,
+            'ffprobe': ffprobe is not None,
+            'nvenc': 'nvenc' in (encoders or ''),
+            'cuda': 'cuda' in (hwaccels or ''),
+        }
+
+
+    def applyCapabilities(self, task):
+        """
+        Store the results of capability detection as soon as it finishes, updating the settings window if it is open
+        """
+        if (task.cancelled() or (task.exception() is not None)):
+            return # reported when compression awaits the task
+
+        capabilities = task.result()
+        self.nvenc = capabilities['nvenc']
+        self.cuda = capabilities['cuda']
+
+        if (self.settingsWindow):
+            self.settingsWindow.updateBackend()
+
+
+    def buildEncoder(self, profile):
+        """
+        Resolve the ffmpeg settings for a profile (overrides of the global settings)
+        """
+        videoCodec = profile.get('video_codec', self.videoCodec)
+        crf = profile.get('constant_rate_factor', self.crf)
+        speed = profile.get('speed', self.speed)
+        acodec = profile.get('audio_codec', self.acodec)
+        abitrate = profile.get('bitrate', self.abitrate)
 
-        result = subprocess.run(['ffmpeg', '-hwaccels'], capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW)
-        self.cuda = ('cuda' in result.stdout)
+        # hardware acceleration
+        backend = selectBackend(videoCodec, self.nvenc)
+        vcodec = backend.name
 
         # speed
-        presetConfig = 'nvenc' if nvenc else 'default'
-        speed = round(self.speed / (len(FFMPEG_SPEEDS['default']) - 1) * (len(FFMPEG_SPEEDS[presetConfig]) - 1))
-        self.preset = FFMPEG_SPEEDS[presetConfig][speed]
+        preset = backend.preset(speed)
+
+        # tunes are specific to each encoder
+        tune = profile.get('tune', self.tune)
+        if (tune and (tune not in backend.tunes)):
+            print(f'\t\tWARNING: {vcodec} does not support tune {tune} (ignoring it)')
+            tune = None
+
+        return {
+            'backend': backend,
+            'vcodec': vcodec,
+            'crf': crf,
+            'preset': preset,
+            'tune': tune,
+            'maxResolution': profile.get('max_resolution', self.maxResolution),
+            'maxFrameRate': profile.get('max_frame_rate', self.maxFrameRate),
+            'scaler': profile.get('scaler', self.scaler),
+            'acodec': acodec,
+            'abitrate': abitrate,
+            'comment': COMMENT_TEMPLATE.format(COMPRESSION_TAG, vcodec, crf, preset, acodec, abitrate), # metadata
+        }
+
+
+    def resolveEncoder(self, inputFile, metadata):
+        """
+        Get the ffmpeg settings for a file, from the rules which match it
+        """
+        key, profile = self.rules.resolve(inputFile, metadata)
 
-        # metadata
-        self.compressionComment = COMMENT_TEMPLATE.format(COMPRESSION_TAG, self.vcodec, self.crf, self.preset, self.acodec, self.abitrate)
+        encoder = self.encoders.get(key)
+        if (encoder is None):
+            encoder = self.encoders[key] = self.buildEncoder(profile)
+        return encoder
 
 
     def openSettingsWindow(self):
         """
         Open the settings window
         """
+        from tkinter import messagebox
+
         if (self.isAlive):
             messagebox.showwarning("Warning", f"A compression process is currently in progress. \nAny changes made will not affect the current process.")
 
@@ -260,6 +377,7 @@ class MainWindow(tk.Tk):
                 progress = round(self.progressbar['value'], 1)
 
                 self.timerLabel['text'] = f'{self.formatTime(self.currentFileTime)}  |  {progress}%  |  {self.formatTime(self.currentProcessTime)}'
+                self.forecastLabel['text'] = self.formatForecast()
 
             await asyncio.sleep(0.5 - (0.45 * (self.speed / 8)))
 
@@ -275,6 +393,55 @@ class MainWindow(tk.Tk):
         return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
 
+    def formatSize(self, size):
+        """
+        Format bytes into a human-readable string
+        """
+        if (size > FileSizeUnit.GB.value):
+            return f'{size / FileSizeUnit.GB.value:.2f} GB'
+        elif (size > FileSizeUnit.MB.value):
+            return f'{size / FileSizeUnit.MB.value:.2f} MB'
+        else:
+            return f'{size / FileSizeUnit.KB.value:.2f} KB'
+
+
+    def getForecast(self):
+        """
+        Estimate the seconds left in the batch, and the bytes it will save
+        The backlog is assumed to be encoded like the current file; either is None until there is enough history
+        """
+        if ((not self.forecaster) or (not self.currentEncoder)):
+            return None, None
+
+        seconds, bytesSaved = self.forecaster.forecast(self.currentEncoder['vcodec'], self.currentEncoder['preset'], self.backlogBytes)
+
+        # remainder of the current file
+        progress = self.progressbar['value']
+        if ((seconds is not None) and (0 < progress < 100)):
+            seconds += self.currentFileTime * (100 - progress) / progress
+
+        return seconds, bytesSaved
+
+
+    def formatForecast(self):
+        """
+        Format the batch forecast; '+' marks that directories are still to be scanned
+        Without overwrite the sources are kept, so the batch uses space (for the compressed copies) rather than saving it
+        """
+        seconds, bytesSaved = self.getForecast()
+        unscanned = '+' if (self.directoryStack and (len(self.directoryStack) > 0)) else ''
+
+        forecast = []
+        if (seconds is not None):
+            forecast.append(f'ETA {self.formatTime(seconds)}{unscanned}')
+        if (bytesSaved is not None):
+            if (self.overwrite):
+                forecast.append(f'~{self.formatSize(bytesSaved)}{unscanned} to save')
+            else:
+                forecast.append(f'~{self.formatSize(max(0, self.backlogBytes - bytesSaved))}{unscanned} more used')
+        return '  |  '.join(forecast)
+
+
     async def handleAutorun(self):
         """
         Trigger the process automatically if autorun is enabled
@@ -291,7 +458,8 @@ class MainWindow(tk.Tk):
         """
         if (self.isAlive):
             # abort
-            self.process.terminate()
+            if (self.process):
+                self.process.terminate() # otherwise compressFile stops at its next check
             self.process = None
             self.isAlive = False
 
@@ -301,6 +469,7 @@ class MainWindow(tk.Tk):
             #TODO store all tasks and cancel them here
         else:
             # start
+            from tkinter import filedialog
             self.beginProcess(filedialog.askdirectory())
 
 
@@ -308,25 +477,72 @@ class MainWindow(tk.Tk):
         """
         Start the compression process
         """
-        # check ffmpeg is installed
-        for command in ['ffmpeg', 'ffprobe']:
-            try:
-                result = subprocess.run([command, '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, creationflags=subprocess.CREATE_NO_WINDOW)
-                if (result.returncode != 0):
-                    raise Exception(result.returncode)
-            except:
-                messagebox.showerror('Error', f'{command} is not installed. Please install it and try again.')
-                return
+        from tkinter import messagebox
 
         # check if settings are valid
         self.loadSettings()
-        if (self.overwrite and self.crf > 18): # upper threshold for visually lossless is 18
+        try:
+            # check the values of the global settings and of every rule, rather than failing at the first matching file
+            globalProfile = {
+                'video_codec': self.videoCodec,
+                'constant_rate_factor': self.crf,
+                'speed': self.speed,
+                'audio_codec': self.acodec,
+                'bitrate': self.abitrate,
+                'tune': self.tune,
+                'max_resolution': self.maxResolution,
+                'max_frame_rate': self.maxFrameRate,
+                'scaler': self.scaler,
+            }
+            checkProfile({key: value for key, value in globalProfile.items() if value is not None})
+
+            self.rules = RuleEngine(self.ruleConfig)
+            self.encoders = {}
+
+            for i, profile in enumerate([{}] + self.rules.getProfiles()):
+                try:
+                    selectBackend(profile.get('video_codec', self.videoCodec))
+                    checkScaler(profile.get('scaler', self.scaler))
+                except ValueError as e:
+                    raise ValueError(f'rule {i - 1}: {e}' if (i) else e)
+        except ValueError as e:
+            messagebox.showerror('Error', f'Invalid settings in config.json: {e}')
+            self.handleError()
+            return
+
+        crf = max([self.crf] + [profile.get('constant_rate_factor', self.crf) for profile in self.rules.getProfiles()]) # including rules'
+        if (self.overwrite and crf > 18): # upper threshold for visually lossless is 18
             messagebox.showwarning('Warning', "Your current settings will result in a loss of quality! \n\nPlease consider disabling the 'Overwrite source' option or lowering the CRF value.")
 
         if (filepath):
             # final initialization
-            self.directoryStack = [filepath]
-            self.fileStack = []
+            for stack in [self.directoryStack, self.fileStack]:
+                if (stack):
+                    stack.clear() # remove segments left by an aborted run
+
+            pathTable = PathTable()
+            self.directoryStack = SpillStack(pathTable, OUTPUTROOT, self.queueWindow)
+            self.fileStack = SpillStack(pathTable, OUTPUTROOT, self.queueWindow)
+            self.directoryStack.append(filepath)
+
+            self.ioLimiter = MountLimiter(self.ioConcurrency)
+            if (self.prefetcher):
+                self.prefetcher.clear()
+            self.prefetcher = PrefetchCache(self.scratchPath, self.prefetchCacheSize, self.ioLimiter, self.ioBandwidth) if (self.prefetch) else None
+            self.prefetchTask = None
+            self.encodeTime = 0
+            self.ioWaitTime = 0
+
+            self.tags = TagStore(self.inFileTags)
+            self.tagFlush = None
+
+            self.forecaster = Forecaster(FORECAST_PATH, loadCalibration(CALIBRATION_PATH))
+            self.currentEncoder = None
+            self.backlogBytes = 0
+            self.forecastLabel['text'] = ''
+
+            if (self.trace):
+                self.tracer.start(cprofile=self.cprofile)
 
             # start process
             self.currentProcessTime = 0
@@ -351,10 +567,13 @@ class MainWindow(tk.Tk):
         """
         Pause or resume the compression process
         """
+        import psutil
+
         if (self.process):
             if (self.isRunning):
                 # pause
                 psutil.Process(self.process.pid).suspend()
+                self.pauseStart = time.time()
 
                 self.pauseButton['text'] = 'Resume'
                 self.root.title(TURTLE_FACE.format(TURTLE_EYES['sleep'], 'Taking a break...'))
@@ -362,6 +581,7 @@ class MainWindow(tk.Tk):
             else:
                 # resume
                 self.timeOfLastCheck = time.time()
+                self.pausedTime += self.timeOfLastCheck - self.pauseStart
 
                 psutil.Process(self.process.pid).resume()
 
@@ -377,42 +597,51 @@ class MainWindow(tk.Tk):
     async def getNextFile(self):
         """
         Find and trigger compression of the next file
-        This is the main loop, called cyclically by the application (as well as recursively by itself)
+        This is the main loop, called cyclically by the application
         """
 
         self.startButton['text'] = 'Abort'
         self.currentFileTime = 0
 
-        if (len(self.fileStack) > 0):
-            # process files
+        # fetch more files, until some are found (a loop, as trees can have long runs of directories without any)
+        while (len(self.fileStack) == 0):
+            if (len(self.directoryStack) == 0):
+                print('DONE')
+                self.handleDone('DONE :D')
+                return # done
 
-            file = self.fileStack.pop()
-            self.loop.create_task(self.compressFile(file))
+            currentDirectory = self.directoryStack.pop()
+            with self.tracer.span('scan', directory=currentDirectory):
+                self.scanDirectory(currentDirectory)
 
-        else:
-            # fetch more files
-            if (len(self.directoryStack) > 0):
-                currentDirectory = self.directoryStack.pop()
-                for dir in os.listdir(currentDirectory):
+            await asyncio.sleep(0) # keep the GUI responsive during long scans
+            if (not self.isAlive):
+                self.handleDone() # aborted meanwhile
+                return
 
-                    fullPath = os.path.join(currentDirectory, dir)
+        # process files
+        file = self.fileStack.pop()
+        self.loop.create_task(self.compressFile(file))
 
-                    # get future directories
-                    if (os.path.isdir(fullPath)):
-                        self.directoryStack.append(fullPath)
 
-                    # get files
-                    else:
-                        # only process mp4 files
-                        if (fullPath.lower().endswith('.mp4')):
-                            self.fileStack.append(fullPath)
+    def scanDirectory(self, currentDirectory):
+        """
+        Queue the subdirectories and mp4 files of a directory
+        """
+        with os.scandir(currentDirectory) as entries:
+            for entry in entries:
 
-            else:
-                print('DONE')
-                self.handleDone('DONE :D')
-                return # done
+                # get future directories
+                if (entry.is_dir()):
+                    self.directoryStack.append(entry.path)
 
-            await self.getNextFile()
+                # get files
+                else:
+                    # only process mp4 files
+                    if (entry.name.lower().endswith('.mp4')):
+                        self.fileStack.append(entry.path)
+                        if (self.tags.get(entry.path) is None):
+                            self.backlogBytes += entry.stat().st_size # for the forecast, excluding files recorded as processed
 
 
     async def compressFile(self, file):
@@ -420,6 +649,18 @@ class MainWindow(tk.Tk):
         Compress a single file using ffmpeg
         """
 
+        # wait for capability detection (started at launch, and applied by applyCapabilities as it finished)
+        capabilities = await self.capabilities
+        if (not self.isAlive):
+            self.handleDone() # aborted meanwhile
+            return
+        for command in ['ffmpeg', 'ffprobe']:
+            if (not capabilities[command]):
+                from tkinter import messagebox
+                messagebox.showerror('Error', f'{command} is not installed. Please install it and try again.')
+                self.handleError()
+                return
+
         print(file)
         self.statusLabel['text'] = file
 
@@ -439,137 +680,74 @@ class MainWindow(tk.Tk):
         outputFile = os.path.join(OUTPUTROOT, 'data.mp4')
 
         try:
-            # READ METADATA
-            cmd = [
-                'ffprobe',
-                '-v', 'quiet', '-loglevel', 'error',
-                '-print_format', 'json',
-                '-show_format',
-                '-show_streams',
-                inputFile
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW)
-            if (result.returncode != 0):
-                raise Exception(f'ffprobe failed with code {result.returncode}')
-
-            metadata = json.loads(result.stdout)
-
-            shouldCompress = True
-            if ((comment := metadata['format']['tags'].get('comment')) != None) and (COMPRESSION_TAG in comment):
-                # already compressed
-                match = re.search(r'-crf (\d+) -preset (\w+)\)', comment)
-
-                if (match):
-                    crf = int(match.group(1))
-                    preset = match.group(2)
-
-                    if ((crf < self.crf) or (FFMPEG_SPEEDS['default'].index(preset) > FFMPEG_SPEEDS['default'].index(self.preset))):
-                        print(f'\t\tINFO: file has already been compressed (trying with more aggressive settings)')
-                    else:
-                        shouldCompress = False
-                        print(f'\t\tINFO: file has already been compressed (skipping)')
-
-                else:
+            with self.tracer.span('file', file=inputFile):
+                # a file recorded as compressed can be skipped without reading it, unless rules depend on its metadata
+                recordedComment = self.tags.get(inputFile)
+                if (recordedComment is None):
+                    self.backlogBytes = max(0, self.backlogBytes - os.path.getsize(inputFile)) # as counted by scanDirectory
+                if ((recordedComment is not None) and (not self.rules.needsMetadata) and (not self.isCompressionNeeded(recordedComment, self.resolveEncoder(inputFile, {})))):
                     shouldCompress = False
-                    print(f'\t\tINFO: file has already been compressed (skipping)')
-
-            if (shouldCompress):
-                self.originalFileSize = int(metadata['format']['size']) # in bytes
 
-                if (self.originalFileSize > FileSizeUnit.GB.value):
-                    originalFileSize = self.originalFileSize / FileSizeUnit.GB.value
-                    fileSizeLabel = 'GB'
-                elif (self.originalFileSize > FileSizeUnit.MB.value):
-                    originalFileSize = self.originalFileSize / FileSizeUnit.MB.value
-                    fileSizeLabel = 'MB'
                 else:
-                    originalFileSize = self.originalFileSize / FileSizeUnit.KB.value
-                    fileSizeLabel = 'KB'
-
-                self.originalSizeLabel['text'] = f'{originalFileSize:.2f} {fileSizeLabel}'
-                self.newSizeLabel['fg'] = 'green'
-
-                # COMPRESS FILE
-                cmd = ['ffmpeg']
-
-                if (self.cuda):
-                    # hardware acceleration
-                    cmd.append('-hwaccel')
-                    cmd.append('cuda')
-
-                for arg in [
-                    '-y',
-                    '-i', inputFile,
-                    '-c:v', self.vcodec,
-                    '-crf', str(self.crf),
-                    '-cq', str(self.crf),
-                    '-rc', 'vbr_hq',            # Variable Bit Rate with High Quality mode
-                    '-b:v', '0',                # Set bitrate to 0 for VBR mode
-                    '-preset', self.preset,
-                    '-c:a', self.acodec,        # audio codec
-                    '-b:a', self.abitrate,
-                    '-threads', str(availableCores),
-                    '-metadata', f'comment={self.compressionComment}',
-                    '-x265-params', 'log-level=quiet'
-                ]:
-                    cmd.append(arg)
-
-                for key, value in metadata['format']['tags'].items():
-                    # metadata
-                    cmd.append('-metadata')
-                    cmd.append(f'{key}={value}')
-                    pass
-
-                # output file
-                cmd.append(outputFile)
-
-                self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, universal_newlines=True, creationflags=subprocess.CREATE_NO_WINDOW)
-                print(' '.join(cmd))
-
-                # limit resources
-                self.setProcessPriority(list(range(availableCores)), [psutil.BELOW_NORMAL_PRIORITY_CLASS, psutil.NORMAL_PRIORITY_CLASS, psutil.REALTIME_PRIORITY_CLASS][self.performanceMode])
-
-                # trigger progress handler
-                self.loop.create_task(self.handleOutput(int(metadata['streams'][0]['nb_frames'])))
-
-                while (self.process.poll() is None):
-                    await asyncio.sleep(0)
-
-                # HANDLE RESULT
-                if (self.process.returncode != 0):
-                    raise Exception(f'ffmpeg failed with code {self.process.returncode}')
-
-                inputFileSize = os.path.getsize(file)
-                outputFileSize = os.path.getsize(outputFile)
-
-                if (outputFileSize >= inputFileSize):
-                    print(f'\t\tERROR: result is not smaller than source')
-                    os.remove(outputFile)
-
-                    try:
-                        sourceMp4 = MP4(inputFile)
+                    # READ METADATA
+                    with self.tracer.span('probe', file=inputFile):
+                        metadata = self.probeFile(inputFile)
+
+                    encoder = self.resolveEncoder(inputFile, metadata)
+                    shouldCompress = self.isCompressionNeeded(recordedComment or metadata['format'].get('tags', {}).get('comment'), encoder) # the sidecar is newer than the file's own comment
+
+                if (shouldCompress):
+                    self.originalFileSize = int(metadata['format']['size']) # in bytes
+
+                    if (self.originalFileSize > FileSizeUnit.GB.value):
+                        originalFileSize = self.originalFileSize / FileSizeUnit.GB.value
+                        fileSizeLabel = 'GB'
+                    elif (self.originalFileSize > FileSizeUnit.MB.value):
+                        originalFileSize = self.originalFileSize / FileSizeUnit.MB.value
+                        fileSizeLabel = 'MB'
+                    else:
+                        originalFileSize = self.originalFileSize / FileSizeUnit.KB.value
+                        fileSizeLabel = 'KB'
 
-                        # Set the comment field to the desired text
-                        sourceMp4['\xa9cmt'] = f'< {self.compressionComment}'  # '\xa9cmt' is the atom for the comment field
-                        sourceMp4.save()
+                    self.originalSizeLabel['text'] = f'{originalFileSize:.2f} {fileSizeLabel}'
+                    self.newSizeLabel['fg'] = 'green'
 
-                        print('\tMetadata updated successfully.')
-                    except Exception as e:
-                        print(f"\tError updating metadata: '{e}'")
+                    # downscale policy
+                    scaling = planScaling(metadata, encoder['maxResolution'], encoder['maxFrameRate'], encoder['scaler'])
+                    if (scaling):
+                        frameRate = f' @ {scaling["frameRate"]:.3g} fps' if (scaling['frameRate']) else '' # unknown for some sources
+                        print(f'\t\tINFO: downscaling to {scaling["width"]}x{scaling["height"]}{frameRate} (estimated {scaling["timeRatio"]:.0%} of the encode time, {scaling["sizeRatio"]:.0%} of the size)')
 
-                else:
-                    if (self.overwrite):
-                        print(f'\t\tINFO: overwriting source file')
-                        shutil.move(outputFile, inputFile)
-                        self.log([inputFile, f'{inputFileSize / 1000000:.2f} MB --> {outputFileSize / 1000000:.2f} MB'])
-                    else:
-                        print(f'\t\tINFO: saving to output directory')
-                        fileName = os.path.basename(file)[:-4] #exclude .mp4
-                        shutil.move(outputFile, os.path.join(os.path.dirname(inputFile), f'{fileName} (compressed).mp4'))
-                        self.log([f'{inputFile} (--> ...(compressed))', f'{inputFileSize / 1000000:.2f} MB --> {outputFileSize / 1000000:.2f} MB'])
+                    # COMPRESS FILE
+                    self.currentEncoder = encoder
+                    encodeSource = await self.takePrefetched(inputFile)
+                    self.checkAborted()
+                    self.schedulePrefetch()
 
-            self.isRunning = False
-            self.loop.create_task(self.getNextFile())
+                    try:
+                        start, pausedTime = time.time(), self.pausedTime
+                        with self.tracer.span('encode', file=inputFile):
+                            await self.encodeFile(encodeSource, outputFile, metadata, encoder, scaling, availableCores)
+                        encodeSeconds = time.time() - start - (self.pausedTime - pausedTime) # excluding pauses
+                        self.encodeTime += encodeSeconds
+                    finally:
+                        if (self.prefetcher):
+                            self.prefetcher.release(inputFile)
+                    self.checkAborted()
+
+                    # learn from the encode, for the batch forecast
+                    self.forecaster.record(encoder['vcodec'], encoder['preset'], metadata, encodeSeconds, self.originalFileSize, os.path.getsize(outputFile))
+                    self.forecaster.save()
+
+                    # HANDLE RESULT
+                    with self.tracer.span('finalize', file=inputFile):
+                        await self.finalizeFile(inputFile, outputFile, encoder)
+                    self.checkAborted()
+
+                    self.reportForecast()
+
+                self.isRunning = False
+                self.loop.create_task(self.getNextFile())
 
         except Exception as e:
             if (not self.isAlive):
@@ -580,10 +758,229 @@ class MainWindow(tk.Tk):
                 self.handleError()
 
 
+    def checkAborted(self):
+        """
+        Stop compressFile after an await during which the process was aborted
+        """
+        if (not self.isAlive):
+            raise Exception('aborted')
+
+
+    def isCompressionNeeded(self, comment, encoder):
+        """
+        Check whether a file should be compressed, given its compression comment (if any) and the encoder settings
+        """
+        if ((comment is None) or (COMPRESSION_TAG not in comment)):
+            return True
+
+        # already compressed
+        match = re.search(r'-c:v (\S+) -crf (\d+) -preset (\w+)', comment)
+
+        if (match):
+            backend = getBackend(match.group(1))
+            crf = int(match.group(2))
+            preset = match.group(3)
+
+            # settings are only comparable within a codec
+            sameCodec = (backend is not None) and (backend.codec == encoder['backend'].codec)
+            fasterPreset = sameCodec and ((backend.effort(preset) or 0) > encoder['backend'].effort(encoder['preset']))
+
+            if (sameCodec and ((crf < encoder['crf']) or fasterPreset)):
+                print(f'\t\tINFO: file has already been compressed (trying with more aggressive settings)')
+                return True
+
+        print(f'\t\tINFO: file has already been compressed (skipping)')
+        return False
+
+
+    def recordTag(self, path, comment, tagFile=True):
+        """
+        Record a file's compression comment, writing the batch in the background once it is full
+        """
+        if (self.tags.record(path, comment, tagFile) and ((self.tagFlush is None) or self.tagFlush.done())):
+            self.tagFlush = self.loop.run_in_executor(None, self.flushTags)
+            self.tagFlush.add_done_callback(self.handleTagFlushDone)
+
+
+    def handleTagFlushDone(self, future):
+        """
+        Report a background tag flush which failed, as nothing else awaits it
+        """
+        if ((not future.cancelled()) and (future.exception() is not None)):
+            print(f"\tError writing tags: '{future.exception()}'")
+            self.log([f'ERROR: writing tags failed ({future.exception()})'])
+
+
+    def flushTags(self):
+        """
+        Write the recorded comments
+        """
+        with self.tracer.span('tag', files=len(self.tags.pending)):
+            self.tags.flush()
+
+
+    async def takePrefetched(self, inputFile):
+        """
+        Get the local copy of a file if it has been prefetched, waiting for an in-progress prefetch
+        """
+        if (not self.prefetcher):
+            return inputFile
+
+        start = time.time()
+        with self.tracer.span('io-wait', file=inputFile):
+            if (self.prefetchTask and self.prefetchTask[0] == inputFile):
+                try:
+                    await self.prefetchTask[1]
+                except Exception as e:
+                    print(f'\t\tWARNING: prefetch failed ({e})')
+            localFile = self.prefetcher.get(inputFile)
+        self.ioWaitTime += time.time() - start
+
+        return localFile or inputFile
+
+
+    def schedulePrefetch(self):
+        """
+        Copy the next queued file to local scratch in the background, unless it is recorded as already processed
+        """
+        if (self.prefetcher and (len(self.fileStack) > 0)):
+            nextFile = self.fileStack.peek()
+            if (self.tags.get(nextFile) is not None):
+                return # likely to be skipped without being read
+            self.prefetchTask = (nextFile, self.loop.run_in_executor(None, self.prefetcher.fetch, nextFile))
+
+
+    def probeFile(self, inputFile):
+        """
+        Read the format and stream metadata of a file using ffprobe
+        """
+        cmd = [
+            'ffprobe',
+            '-v', 'quiet', '-loglevel', 'error',
+            '-print_format', 'json',
+            '-show_format',
+            '-show_streams',
+            inputFile
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        if (result.returncode != 0):
+            raise Exception(f'ffprobe failed with code {result.returncode}')
+
+        return json.loads(result.stdout)
+
+
+    async def encodeFile(self, inputFile, outputFile, metadata, encoder, scaling, availableCores):
+        """
+        Encode a file into the output file using ffmpeg, and wait for it to finish
+        """
+        import psutil
+
+        cmd = ['ffmpeg']
+
+        if (self.cuda):
+            # hardware acceleration
+            cmd.append('-hwaccel')
+            cmd.append('cuda')
+
+        for arg in [
+            '-y',
+            '-i', inputFile,
+            *encoder['backend'].args(encoder['crf'], encoder['preset'], availableCores, encoder['tune']),
+            '-c:a', encoder['acodec'],  # audio codec
+            '-b:a', encoder['abitrate'],
+            '-metadata', f'comment={encoder["comment"]}',
+        ]:
+            cmd.append(arg)
+
+        if (scaling):
+            cmd.append('-vf')
+            cmd.append(scaling['filters'])
+
+        for key, value in metadata['format']['tags'].items():
+            # metadata
+            cmd.append('-metadata')
+            cmd.append(f'{key}={value}')
+            pass
+
+        # output file
+        cmd.append(outputFile)
+
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1, universal_newlines=True, creationflags=subprocess.CREATE_NO_WINDOW)
+        print(' '.join(cmd))
+
+        # limit resources
+        self.setProcessPriority(list(range(availableCores)), [psutil.BELOW_NORMAL_PRIORITY_CLASS, psutil.NORMAL_PRIORITY_CLASS, psutil.REALTIME_PRIORITY_CLASS][self.performanceMode])
+
+        # trigger progress handler
+        targetFrames = int(metadata['streams'][0]['nb_frames'])
+        if (scaling):
+            targetFrames = max(1, int(targetFrames * scaling['frameRatio']))
+        self.loop.create_task(self.handleOutput(targetFrames))
+
+        while (self.process.poll() is None):
+            await asyncio.sleep(0)
+
+        if (self.process.returncode != 0):
+            raise Exception(f'ffmpeg failed with code {self.process.returncode}')
+
+
+    async def finalizeFile(self, inputFile, outputFile, encoder):
+        """
+        Keep the encoded file if it is smaller than the source, otherwise discard it and tag the source
+        """
+        inputFileSize = os.path.getsize(inputFile)
+        outputFileSize = os.path.getsize(outputFile)
+
+        if (outputFileSize >= inputFileSize):
+            print(f'\t\tERROR: result is not smaller than source')
+            os.remove(outputFile)
+
+            # remember the attempt, so the file is skipped next time
+            self.recordTag(inputFile, f'< {encoder["comment"]}')
+
+        else:
+            if (self.overwrite):
+                print(f'\t\tINFO: overwriting source file')
+                await self.moveOutput(outputFile, inputFile)
+                self.recordTag(inputFile, encoder['comment'], tagFile=False) # ffmpeg already wrote the comment
+                self.log([inputFile, f'{inputFileSize / 1000000:.2f} MB --> {outputFileSize / 1000000:.2f} MB'])
+            else:
+                print(f'\t\tINFO: saving to output directory')
+                fileName = os.path.basename(inputFile)[:-4] #exclude .mp4
+                compressedFile = os.path.join(os.path.dirname(inputFile), f'{fileName} (compressed).mp4')
+                await self.moveOutput(outputFile, compressedFile)
+                self.recordTag(compressedFile, encoder['comment'], tagFile=False) # ffmpeg already wrote the comment
+                self.log([f'{inputFile} (--> ...(compressed))', f'{inputFileSize / 1000000:.2f} MB --> {outputFileSize / 1000000:.2f} MB'])
+
+
+    def reportForecast(self):
+        """
+        Output the updated batch forecast
+        """
+        forecast = self.formatForecast()
+        self.forecastLabel['text'] = forecast
+        if (forecast):
+            print(f'\t\tFORECAST: {forecast}')
+            self.log([f'FORECAST: {forecast}'])
+
+
+    async def moveOutput(self, outputFile, destination):
+        """
+        Move the encoded file to its destination, within the I/O limits
+        The move runs off the event loop, as throttling and waiting for mount slots would otherwise freeze the GUI
+        """
+        start = time.time()
+        with self.tracer.span('move', file=destination):
+            await self.loop.run_in_executor(None, moveFile, outputFile, destination, self.ioLimiter, self.ioBandwidth)
+        self.ioWaitTime += time.time() - start
+
+
     def setProcessPriority(self, affinity, priority):
         """
         Set the priority of the ffmpeg process
         """
+        import psutil
+
         if (self.process):
             psutil.Process(self.process.pid).cpu_affinity(affinity)
             psutil.Process(self.process.pid).nice(priority)
@@ -629,14 +1026,51 @@ class MainWindow(tk.Tk):
             await asyncio.sleep(0)
 
 
+    def finishTrace(self):
+        """
+        Stop profiling, save the trace and report the time spent in each stage
+        """
+        if (not self.tracer.enabled):
+            return
+
+        self.tracer.stop()
+
+        date = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        tracePath = os.path.join(LOG_DIR, f'trace_{date}.json')
+        self.tracer.save(tracePath, os.path.join(LOG_DIR, f'profile_{date}.prof'))
+
+        summary = self.tracer.formatSummary()
+        print('\n'.join(summary))
+        self.log([tracePath] + summary)
+
+
+    def finishIO(self):
+        """
+        Write outstanding tags, remove prefetched copies and report the time spent waiting on I/O, separately from encoding
+        """
+        if (self.tags):
+            self.flushTags()
+
+        if (self.prefetcher):
+            self.prefetcher.clear()
+
+        if (self.encodeTime or self.ioWaitTime):
+            times = [f'encode: {self.formatTime(self.encodeTime)}', f'I/O wait: {self.formatTime(self.ioWaitTime)}']
+            print('\t'.join(times))
+            self.log(times)
+
+
     def handleDone(self, message=''):
         """
         Display completion in the GUI
         """
+        self.finishIO()
+        self.finishTrace()
         self.isAlive = False
         self.isRunning = False
         self.statusLabel['text'] = message
         self.statusLabel['fg'] = 'green'
+        self.forecastLabel['text'] = ''
         self.startButton['text'] = 'Start'
         self.turtleLegs['text'] = ''
         self.turtleBody['text'] = f'\n{TURTLE_ASCII.format(TURTLE_EYES["blink"])}'
@@ -648,6 +1082,8 @@ class MainWindow(tk.Tk):
         """
         Display error message in the GUI
         """
+        self.finishIO()
+        self.finishTrace()
         self.isRunning = False
         self.isAlive = False
         self.statusLabel['text'] = 'ERROR :ᗡ'
@@ -683,6 +1119,7 @@ class SettingsWindow(tk.Tk):
         Initialize the tkinter window
         """
         super().__init__()
+        from idlelib.tooltip import Hovertip
 
         self.loop = loop
         self.parent = parent
@@ -730,7 +1167,7 @@ class SettingsWindow(tk.Tk):
         self.speedLabel = tk.Label(self, text='Efficiency:', fg='green')
         self.speedLabel.grid(row=6, column=0, sticky='E', padx=(10, 5), pady=(5, 5))
 
-        self.speedScale = tk.Scale(self, from_=0, to=8, orient=tk.HORIZONTAL, length=200, command=self.handlePresetChange, showvalue=0, label=FFMPEG_SPEEDS['default'][0])
+        self.speedScale = tk.Scale(self, from_=0, to=SPEEDS - 1, orient=tk.HORIZONTAL, length=200, command=self.handlePresetChange, showvalue=0, label=X264.presets[0])
         Hovertip(self.speedScale,'Level of compression efficiency \n(affects compression speed) \n\n"Use the slowest preset that you have patience for"', hover_delay=200)
         self.speedScale.grid(row=6, column=1, sticky='W', padx=(5, 10), pady=(5, 5))
 
@@ -780,6 +1217,10 @@ class SettingsWindow(tk.Tk):
         if (not self.config):
             self.config = {}
 
+        # encoder, for the efficiency labels
+        self.calibration = loadCalibration(CALIBRATION_PATH)
+        self.updateBackend()
+
         # READ
         self.autorunCheckbox.select() if (self.config.get('autorun', False)) else self.autorunCheckbox.deselect()
         self.startupCheckbox.select() if (self.config.get('startup', False)) else self.startupCheckbox.deselect()
@@ -792,10 +1233,24 @@ class SettingsWindow(tk.Tk):
         self.fileOverwriteCheckbox.select() if (self.config.get('overwrite', False)) else self.fileOverwriteCheckbox.deselect()
 
 
+    def updateBackend(self):
+        """
+        Resolve the configured encoder (which depends on the detected hardware) and refresh its preset label
+        """
+        try:
+            self.backend = selectBackend(self.config.get('video_codec', 'h265'), self.parent.nvenc)
+        except ValueError:
+            self.backend = selectBackend('h265', self.parent.nvenc)
+
+        self.handlePresetChange(self.config.get('speed', 0)) # config tracks unsaved changes
+
+
     def saveSettings(self):
         """
         Save settings from class variables into config.json
         """
+        import winreg as wr
+
 
         with open(CONFIG_PATH, 'w') as f:
             json.dump(self.config, f, indent=4, sort_keys=True)
@@ -839,7 +1294,14 @@ class SettingsWindow(tk.Tk):
         value= int(value)
         self.config['speed'] = value
 
-        self.speedScale.config(label=FFMPEG_SPEEDS['default'][value])
+        preset = self.backend.preset(value)
+        label = f'preset {preset}' if (preset.isdigit()) else preset
+
+        calibration = self.calibration.get(self.backend.name, {}).get(preset)
+        if (calibration):
+            label += f' (~{calibration["fps"]:.0f} fps)' # measured by benchmark.py --calibrate
+
+        self.speedScale.config(label=label)
 
         if (value <= 2):
             self.speedLabel['fg'] = 'green'
@@ -885,10 +1347,13 @@ class SettingsWindow(tk.Tk):
         """
         Handle autorun directory selection
         """
+        from tkinter import filedialog
+
         dir = filedialog.askdirectory()
         if (dir):
             self.config['autorunPath'] = dir
             self.setAutorunDirectory(dir)
 
 
-asyncio.run(App().exec())
+if (__name__ == '__main__'):
+    asyncio.run(App().exec())
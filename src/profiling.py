@@ -0,0 +1,136 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Span:
+    """
+    A timed region of the pipeline, recorded as a Chrome trace 'complete' event
+    """
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        end = time.perf_counter_ns()
+        if (excType is not None):
+            self.args['error'] = excType.__name__
+        self.tracer.record(self.name, self.start, end, self.args)
+        return False
+
+
+class Tracer:
+    """
+    Low-overhead recorder of stage timings (disabled by default)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.profiler = None
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+
+
+    def start(self, cprofile=False):
+        """
+        Begin recording spans (and optionally profiling the Python side with cProfile)
+        """
+        self.events = []
+        self.origin = time.perf_counter_ns()
+        self.enabled = True
+
+        if (cprofile):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+    def stop(self):
+        """
+        Stop recording; recorded spans are kept until the next start
+        """
+        self.enabled = False
+        if (self.profiler):
+            self.profiler.disable()
+
+
+    def span(self, name, **args):
+        """
+        Time a region of code; a shared no-op context is returned while disabled
+        """
+        if (not self.enabled):
+            return NULL_SPAN
+        return Span(self, name, args)
+
+
+    def record(self, name, start, end, args):
+        """
+        Store a finished span
+        """
+        self.events.append((name, start, end, threading.get_ident(), args))
+
+
+    def summary(self):
+        """
+        Aggregate the recorded spans by name
+        """
+        stages = {}
+        for name, start, end, _, _ in self.events:
+            duration = (end - start) / 10 ** 9
+            stage = stages.setdefault(name, {'count': 0, 'total': 0.0, 'mean': 0.0, 'max': 0.0})
+            stage['count'] += 1
+            stage['total'] += duration
+            stage['max'] = max(stage['max'], duration)
+
+        for stage in stages.values():
+            stage['mean'] = stage['total'] / stage['count']
+
+        return stages
+
+
+    def formatSummary(self):
+        """
+        Format the aggregated spans as a table, slowest stage first
+        """
+        stages = self.summary()
+        lines = [f'{"stage":<12}{"count":>8}{"total (s)":>12}{"mean (s)":>12}{"max (s)":>12}']
+        for name, stage in sorted(stages.items(), key=lambda item: item[1]['total'], reverse=True):
+            lines.append(f'{name:<12}{stage["count"]:>8}{stage["total"]:>12.3f}{stage["mean"]:>12.3f}{stage["max"]:>12.3f}')
+        return lines
+
+
+    def save(self, tracePath, profilePath=None):
+        """
+        Write the spans as Chrome trace/Perfetto JSON, and the cProfile stats if captured
+        """
+        traceEvents = []
+        for name, start, end, tid, args in self.events:
+            traceEvents.append({
+                'name': name,
+                'cat': 'stage',
+                'ph': 'X',
+                'ts': (start - self.origin) / 1000, # in microseconds
+                'dur': (end - start) / 1000,
+                'pid': self.pid,
+                'tid': tid,
+                'args': args,
+            })
+
+        with open(tracePath, 'w') as f:
+            json.dump({'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}, f)
+
+        if (self.profiler and profilePath):
+            self.profiler.dump_stats(profilePath)
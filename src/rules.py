@@ -0,0 +1,231 @@
+import numbers
+import re
+
+from encoders import MAX_CRF, SPEEDS
+
+# match key --> (metadata field, bound); min bounds are inclusive lower limits, max bounds inclusive upper limits
+BOUNDS = {
+    'minWidth': ('width', min), 'maxWidth': ('width', max),
+    'minHeight': ('height', min), 'maxHeight': ('height', max),
+    'minDuration': ('duration', min), 'maxDuration': ('duration', max),
+    'minBitrate': ('bitrate', min), 'maxBitrate': ('bitrate', max),
+}
+PATH_KEYS = ['path', 'regex']
+PROFILE_KEYS = ['video_codec', 'constant_rate_factor', 'speed', 'audio_codec', 'bitrate', 'tune', 'max_resolution', 'max_frame_rate', 'scaler']
+# profile key --> (expected type, lower limit, upper limit); limits are inclusive, and only apply to numbers
+PROFILE_TYPES = {
+    'video_codec': (str, None, None),
+    'constant_rate_factor': (int, 0, MAX_CRF),
+    'speed': (int, 0, SPEEDS - 1),
+    'audio_codec': (str, None, None),
+    'bitrate': (str, None, None),
+    'tune': (str, None, None),
+    'max_resolution': (numbers.Real, 2, None),
+    'max_frame_rate': (numbers.Real, 1, None),
+    'scaler': (str, None, None),
+}
+
+
+def globToRegex(pattern):
+    """
+    Translate a path glob (`*`, `?` and `**` across directories) into a regex
+    """
+    out = []
+    i = 0
+    while (i < len(pattern)):
+        if (pattern.startswith('**/', i)):
+            out.append('(?:.*/)?')
+            i += 3
+        elif (pattern.startswith('**', i)):
+            out.append('.*')
+            i += 2
+        elif (pattern[i] == '*'):
+            out.append('[^/]*')
+            i += 1
+        elif (pattern[i] == '?'):
+            out.append('[^/]')
+            i += 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(out)
+
+
+def isNumber(value):
+    """
+    Check that a config value is a number (JSON booleans are not)
+    """
+    return isinstance(value, numbers.Real) and (not isinstance(value, bool))
+
+
+def checkProfile(profile):
+    """
+    Raise ValueError for a profile with unknown keys, or values of the wrong type or out of range
+    """
+    unknown = set(profile) - set(PROFILE_KEYS)
+    if (unknown):
+        raise ValueError(f'unknown profile key(s) {", ".join(sorted(unknown))}')
+
+    for key, value in profile.items():
+        expected, lower, upper = PROFILE_TYPES[key]
+        if ((expected is str) and (not isinstance(value, str))):
+            raise ValueError(f'{key} must be a string, not {value!r}')
+        if (expected is not str):
+            if ((not isNumber(value)) or ((expected is int) and (value != int(value)))):
+                raise ValueError(f'{key} must be {"an integer" if (expected is int) else "a number"}, not {value!r}')
+            if (((lower is not None) and (value < lower)) or ((upper is not None) and (value > upper))):
+                raise ValueError(f'{key} must be {f"between {lower} and {upper}" if (upper is not None) else f"at least {lower}"}, not {value!r}')
+
+
+def getFileInfo(metadata):
+    """
+    Extract the source fields used by rules and encode policies from ffprobe's output
+    """
+    video = next((stream for stream in metadata.get('streams', []) if stream.get('codec_type') == 'video'), {})
+    format = metadata.get('format', {})
+
+    def number(value):
+        try:
+            if (isinstance(value, str) and ('/' in value)):
+                numerator, denominator = value.split('/')
+                return float(numerator) / float(denominator) # e.g. frame rates, '30000/1001'
+            return float(value)
+        except (TypeError, ValueError, ZeroDivisionError):
+            return None
+
+    return {
+        'width': number(video.get('width')),
+        'height': number(video.get('height')),
+        'duration': number(format.get('duration')),
+        'bitrate': number(format.get('bit_rate')),
+        'codec': video.get('codec_name'),
+        'frameRate': number(video.get('avg_frame_rate')) or number(video.get('r_frame_rate')),
+        'frames': number(video.get('nb_frames')),
+    }
+
+
+class RuleEngine:
+    """
+    Encode profiles selected per file by rules from config.json
+    Every matching rule is applied in order, so later rules override earlier ones
+
+        {"match": {"path": "**/Dashcam/**", "minHeight": 1080}, "profile": {"constant_rate_factor": 30}}
+
+    Rules are compiled once; the merged profile of each combination of matching rules is cached
+    """
+
+    def __init__(self, rules):
+        self.pathPatterns = [] # compiled, shared by rules with identical patterns
+        self.rules = [] # (path pattern index, bounds, codecs, profile)
+        self.profiles = {}
+
+        if (not isinstance(rules, list)):
+            raise ValueError('rules must be a list')
+
+        patterns = {}
+        for i, rule in enumerate(rules):
+            if (not isinstance(rule, dict)):
+                raise ValueError(f'rule {i}: must be an object with match and profile')
+            match = rule.get('match', {})
+            profile = rule.get('profile', {})
+            if ((not isinstance(match, dict)) or (not isinstance(profile, dict))):
+                raise ValueError(f'rule {i}: match and profile must be objects')
+
+            unknown = set(match) - set(BOUNDS) - set(PATH_KEYS) - {'codec'}
+            if (unknown):
+                raise ValueError(f'rule {i}: unknown match key(s) {", ".join(sorted(unknown))}')
+            if (('path' in match) and ('regex' in match)):
+                raise ValueError(f'rule {i}: use either path or regex, not both')
+            for key in PATH_KEYS:
+                if ((key in match) and (not isinstance(match[key], str))):
+                    raise ValueError(f'rule {i}: {key} must be a string')
+            for key in BOUNDS:
+                if ((key in match) and (not isNumber(match[key]))):
+                    raise ValueError(f'rule {i}: {key} must be a number, not {match[key]!r}')
+            codecs = match.get('codec')
+            if ((codecs is not None) and (not isinstance(codecs, str)) and ((not isinstance(codecs, list)) or (not all(isinstance(codec, str) for codec in codecs)))):
+                raise ValueError(f'rule {i}: codec must be a string or a list of strings')
+
+            try:
+                checkProfile(profile)
+            except ValueError as e:
+                raise ValueError(f'rule {i}: {e}')
+
+            # path
+            pattern = None
+            if ('path' in match):
+                pattern = '(?s:' + globToRegex(match['path'].replace('\\', '/')) + r')\Z'
+            elif ('regex' in match):
+                pattern = match['regex']
+
+            patternIndex = None
+            if (pattern is not None):
+                if (pattern not in patterns):
+                    try:
+                        compiled = re.compile(pattern, re.IGNORECASE)
+                    except re.error as e:
+                        raise ValueError(f'rule {i}: invalid pattern ({e})')
+                    patterns[pattern] = len(self.pathPatterns)
+                    self.pathPatterns.append(compiled.match if ('path' in match) else compiled.search)
+                patternIndex = patterns[pattern]
+
+            # metadata
+            bounds = tuple((BOUNDS[key][0], BOUNDS[key][1] is min, float(value)) for key, value in match.items() if key in BOUNDS)
+
+            if (isinstance(codecs, str)):
+                codecs = [codecs]
+            codecs = frozenset(codec.lower() for codec in codecs) if (codecs) else None
+
+            self.rules.append((patternIndex, bounds, codecs, dict(profile)))
+
+
+    def __len__(self):
+        return len(self.rules)
+
+
+    def getProfiles(self):
+        """
+        Get the profile of each rule, in order, so that callers can validate their values
+        """
+        return [profile for _, _, _, profile in self.rules]
+
+
+    @property
+    def needsMetadata(self):
+        """
+        Whether any rule matches on more than the path, so files must be probed to resolve their profile
+        """
+        return any(bounds or (codecs is not None) for _, bounds, codecs, _ in self.rules)
+
+
+    def resolve(self, path, metadata):
+        """
+        Get the key and merged profile of the rules matching a file
+        Equal keys always have equal profiles, so callers may cache anything derived from the profile by key
+        """
+        if (not self.rules):
+            return (), {}
+
+        path = path.replace('\\', '/')
+        pathMatches = [bool(match(path)) for match in self.pathPatterns]
+        info = getFileInfo(metadata)
+
+        key = []
+        for i, (patternIndex, bounds, codecs, _) in enumerate(self.rules):
+            if ((patternIndex is not None) and (not pathMatches[patternIndex])):
+                continue
+            if ((codecs is not None) and ((info['codec'] or '').lower() not in codecs)):
+                continue
+            if (not all((info[field] is not None) and ((info[field] >= value) if (isMin) else (info[field] <= value)) for field, isMin, value in bounds)):
+                continue
+            key.append(i)
+
+        key = tuple(key)
+        profile = self.profiles.get(key)
+        if (profile is None):
+            profile = {}
+            for i in key:
+                profile.update(self.rules[i][3])
+            self.profiles[key] = profile
+
+        return key, profile
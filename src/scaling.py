@@ -0,0 +1,69 @@
+import math
+
+from rules import getFileInfo
+
+SCALERS = ['fast_bilinear', 'bilinear', 'bicubic', 'lanczos', 'spline']
+DEFAULT_SCALER = 'bicubic'
+
+# rough exponents relating output size to pixels and frames encoded
+# halving the pixels does not halve the bitrate needed for the same quality
+SIZE_PIXEL_EXPONENT = 0.75
+SIZE_FRAME_EXPONENT = 0.5
+
+
+def checkScaler(scaler):
+    """
+    Raise ValueError for an unknown scaling algorithm
+    """
+    if (scaler not in SCALERS):
+        raise ValueError(f'unknown scaler {scaler} (expected one of {", ".join(SCALERS)})')
+
+
+def planScaling(metadata, maxResolution=None, maxFrameRate=None, scaler=DEFAULT_SCALER):
+    """
+    Plan the filters needed to cap a source's resolution (its shorter side) and frame rate, never upscaling
+    Returns None if the source is already within the caps, otherwise the filter chain and estimated savings
+    """
+    info = getFileInfo(metadata)
+    width, height, frameRate = info['width'], info['height'], info['frameRate']
+
+    filters = []
+    plan = {
+        'width': int(width) if (width) else None,
+        'height': int(height) if (height) else None,
+        'frameRate': frameRate,
+        'pixelRatio': 1.0,
+        'frameRatio': 1.0,
+    }
+
+    # frame rate (dropped first, so that fewer frames are scaled)
+    if (maxFrameRate and frameRate and (frameRate > maxFrameRate * 1.01)):
+        divisor = math.ceil(frameRate / maxFrameRate - 0.01) # keep every nth frame, to avoid judder
+        plan['frameRate'] = frameRate / divisor
+        plan['frameRatio'] = 1 / divisor
+        filters.append(f'fps={plan["frameRate"]:.6g}')
+
+    # resolution
+    if (maxResolution and width and height and (min(width, height) > maxResolution)):
+        shortSide = max(2, int(maxResolution) // 2 * 2) # keep dimensions even, as yuv420p requires
+        if (width >= height):
+            plan['height'] = shortSide
+            plan['width'] = round(width * shortSide / height / 2) * 2
+        else:
+            plan['width'] = shortSide
+            plan['height'] = round(height * shortSide / width / 2) * 2
+        plan['pixelRatio'] = (plan['width'] * plan['height']) / (width * height)
+
+        checkScaler(scaler)
+        filters.append(f'scale={plan["width"]}:{plan["height"]}:flags={scaler}')
+
+    if (not filters):
+        return None
+
+    plan['filters'] = ','.join(filters)
+
+    # encode time scales roughly with the number of pixels encoded
+    plan['timeRatio'] = plan['pixelRatio'] * plan['frameRatio']
+    plan['sizeRatio'] = (plan['pixelRatio'] ** SIZE_PIXEL_EXPONENT) * (plan['frameRatio'] ** SIZE_FRAME_EXPONENT)
+
+    return plan
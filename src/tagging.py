@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+SIDECAR_NAME = '.tortle-stomp.jsonl'
+TAG_BATCH = 32 # pending tags written at once
+CACHED_DIRECTORIES = 16
+
+
+class PaddingExhausted(Exception):
+    """
+    Raised to abort an in-file tag which would need the file to be rewritten
+    """
+
+
+def tagFileInPlace(path, comment):
+    """
+    Write the comment atom into an mp4, only if it fits in the existing padding
+    Returns whether the file was tagged
+    """
+    from mutagen.mp4 import MP4
+
+    def keepPadding(info):
+        if (info.padding < 0):
+            raise PaddingExhausted()
+        return info.padding
+
+    try:
+        sourceMp4 = MP4(path)
+        sourceMp4['\xa9cmt'] = comment # '\xa9cmt' is the atom for the comment field
+        sourceMp4.save(padding=keepPadding)
+        return True
+    except PaddingExhausted:
+        return False
+
+
+class TagStore:
+    """
+    Compression state of files, kept in a sidecar file per directory rather than in the files themselves
+    An entry is only valid while the file's size and modification time are unchanged
+    """
+
+    def __init__(self, inFile=False):
+        self.inFile = inFile # also tag the files themselves, where padding allows
+
+        self.directories = OrderedDict() # directory --> {name: entry}, least recently used first
+        self.pending = [] # (path, comment, whether to tag the file itself)
+        self.writing = [] # pending tags taken by the flush in progress
+        self.lock = threading.Lock() # serialises flushes
+        self.cacheLock = threading.Lock() # guards directories, which flushes update from another thread
+
+
+    def load(self, directory):
+        """
+        Get the entries of a directory's sidecar
+        """
+        with self.cacheLock:
+            entries = self.directories.get(directory)
+            if (entries is not None):
+                self.directories.move_to_end(directory)
+                return entries
+
+        entries, lines = self.read(directory)
+        if ((lines > 2 * len(entries) + TAG_BATCH) and self.lock.acquire(blocking=False)):
+            # only compact between flushes, whose appends would otherwise be lost; skipped while one is writing
+            try:
+                entries, _ = self.read(directory) # including anything a flush appended meanwhile
+                self.compact(directory, entries)
+            finally:
+                self.lock.release()
+
+        with self.cacheLock:
+            entries = self.directories.setdefault(directory, entries) # a flush may have loaded it meanwhile
+            while (len(self.directories) > CACHED_DIRECTORIES):
+                self.directories.popitem(last=False)
+
+        return entries
+
+
+    def read(self, directory):
+        """
+        Read a directory's sidecar, returning its latest entries and the number of lines read
+        """
+        entries = {}
+        lines = 0
+        try:
+            with open(os.path.join(directory, SIDECAR_NAME), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry['name']] = entry # later lines win
+                        lines += 1
+                    except (ValueError, KeyError):
+                        pass # ignore a line torn by an interrupted write
+        except OSError:
+            pass
+
+        return entries, lines
+
+
+    def compact(self, directory, entries):
+        """
+        Rewrite a sidecar without superseded entries (lock must be held)
+        """
+        path = os.path.join(directory, SIDECAR_NAME)
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                for entry in entries.values():
+                    f.write(json.dumps(entry) + '\n')
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass # read-only, or in use; try again next time
+
+
+    def get(self, path):
+        """
+        Get the recorded comment of a file, if it is still valid
+        """
+        for pendingPath, comment, _ in reversed(self.writing + self.pending):
+            if (pendingPath == path):
+                return comment
+
+        directory, name = os.path.split(path)
+        entry = self.load(directory).get(name)
+        if (entry is None):
+            return None
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if ((stat.st_size != entry['size']) or (stat.st_mtime_ns != entry['mtime'])):
+            return None # modified since
+
+        return entry['comment']
+
+
+    def record(self, path, comment, tagFile=True):
+        """
+        Queue a comment for a file; returns whether the batch is full and should be flushed
+        Files which already carry the comment (e.g. ffmpeg's output) needn't be tagged themselves
+        """
+        self.pending.append((path, comment, tagFile))
+        return len(self.pending) >= TAG_BATCH
+
+
+    def flush(self):
+        """
+        Write queued comments, appending to each directory's sidecar once
+        """
+        with self.lock:
+            self.writing, self.pending = self.pending, []
+            try:
+                self.write(self.writing)
+            finally:
+                self.writing = []
+
+
+    def write(self, pending):
+        """
+        Tag the files (if enabled) and append their entries to the sidecars (lock must be held)
+        """
+        byDirectory = {}
+        for path, comment, tagFile in pending:
+            if (self.inFile and tagFile):
+                try:
+                    if (not tagFileInPlace(path, comment)):
+                        print(f'\t\tINFO: not enough padding to tag {path} in place (using sidecar)')
+                except Exception as e:
+                    print(f"\tError updating metadata: '{e}'")
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # removed since
+
+            directory, name = os.path.split(path)
+            byDirectory.setdefault(directory, []).append({'name': name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'comment': comment})
+
+        for directory, entries in byDirectory.items():
+            try:
+                with open(os.path.join(directory, SIDECAR_NAME), 'a', encoding='utf-8') as f:
+                    for entry in entries:
+                        f.write(json.dumps(entry) + '\n')
+            except OSError as e:
+                print(f"\tError writing tags: '{e}'")
+                continue
+
+            with self.cacheLock:
+                cached = self.directories.get(directory)
+                if (cached is not None):
+                    for entry in entries:
+                        cached[entry['name']] = entry